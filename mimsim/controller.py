@@ -1,95 +1,162 @@
 # builtin or external imports
 import csv
-from copy import deepcopy
-from typing import NoReturn, Tuple, Iterable
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import NoReturn, Tuple, Iterable, List
 
 # imports from this package
 import mimsim.mimicry as mim
 
-CSV = '.csv'
-XML = '.simu.xml'
-NONE = 'none'
+# output formats for Simulation.run and friends
+CSV = '.csv'  # prey populations per row, alongside a descriptive *.simu.xml written separately
+XML = '.simu.xml'  # description and full results in one *.simu.xml
+NONE = 'none'  # write nothing and build no rows; for benchmarks and sweeps that only inspect the yielded pools
+
+_CSV_BUFFER_SIZE = 1 << 20  # bytes buffered by the output file before each write() to disk
+_CSV_BATCH_ROWS = 1024  # formatted rows accumulated before each write to the output file
+_SKIP_BELOW_USEFUL_CHANCE = 0.5  # _run_gen skips wasted encounters in bulk once fewer than this fraction can matter
+_STALL_CHECK_DECLINES = 256  # declined encounters in a row after which _run_gen checks whether any meal is possible
 
 
 # TODO: optimize using Numba or Cython or something
 
 
-# run a single-generation trial and returns results
-def one_gen(prey_in: mim.PreyPool, pred_in: mim.PredatorPool, number_of_encounters: int) \
-        -> Tuple[mim.PreyPool, mim.PredatorPool]:
-    # Simulation setup
-    prey_pool = deepcopy(prey_in)
-    pred_pool = deepcopy(pred_in)
-
-    # Simulation execution
-    for _ in range(number_of_encounters):
-        if prey_pool.popu(surviving_only=True) > 0 and pred_pool.popu(hungry_only=True) > 0:
-            prey_selected = prey_pool.select(surviving_only=False)[1]
-            pred_spec_selected_name, pred_idx = pred_pool.select(hungry_only=False)
-            pred_spec_selected = pred_pool[pred_spec_selected_name]
-            if prey_selected is not None and pred_idx is not None:
-                if pred_spec_selected.encounter(pred_idx, prey_selected):
-                    prey_selected.popu -= 1
-        else:  # no prey left or no hungry predators left
+# run a single-generation trial in place, mutating prey_pool and pred_pool
+def _run_gen(prey_pool: mim.PreyPool, pred_pool: mim.PredatorPool, number_of_encounters: int,
+             rng: random.Random = None) -> NoReturn:
+    pred_species = pred_pool.dict  # name: PredatorSpecies, fetched once instead of pred_pool[...] per encounter
+    rng = random if rng is None else rng
+    draw = rng.random  # bound once; each encounter's uniform is drawn here and handed to encounter()
+    prey_select = prey_pool.select
+    pred_select = pred_pool.select
+    consume = prey_pool.consume
+    # An encounter only matters if it picks a surviving prey and a hungry predator; any other pick ends in nothing.
+    # Picks are independent and uniform, so once such encounters are rare, the number wasted before the next one that
+    # matters is geometrically distributed. They are then skipped with one draw, and the encounter that matters picks
+    # from the surviving prey and hungry predators directly. Chances only change on a meal, so they are computed then.
+    # In runs where every remaining prey is too distasteful to every hungry predator, no encounter can lead to a meal.
+    # That is checked once per meal after a long enough run of declined encounters, and ends the generation early.
+    prey_total = prey_pool.popu(surviving_only=False)
+    pred_total = pred_pool.popu(hungry_only=False)
+    if prey_total <= 0 or pred_total <= 0:  # every encounter picks from these totals, so none can be useful
+        return
+    encounters_left = number_of_encounters
+    while encounters_left > 0:
+        surviving_popu = prey_pool.popu(surviving_only=True)
+        hungry_popu = pred_pool.popu(hungry_only=True)
+        if surviving_popu <= 0 or hungry_popu <= 0:  # no prey left or no hungry predators left
             break
 
+        useful_chance = surviving_popu * hungry_popu / (prey_total * pred_total)
+        stall_check_at = encounters_left - _STALL_CHECK_DECLINES / useful_chance  # wasted encounters count too
+        if useful_chance >= _SKIP_BELOW_USEFUL_CHANCE:  # plain encounters, until the next meal
+            while encounters_left > 0:
+                encounters_left -= 1
+                prey_selected_name, prey_selected = prey_select(False, rng)  # surviving_only=False
+                pred_spec_selected_name, pred_idx = pred_select(False, rng)  # hungry_only=False
+                if prey_selected is not None:
+                    pred_spec_selected = pred_species[pred_spec_selected_name]
+                    # a full predator declines without drawing, matching encounter()'s own early return
+                    if pred_spec_selected.hungry(pred_idx) and \
+                            pred_spec_selected.encounter(pred_idx, prey_selected, r=draw()):
+                        consume(prey_selected_name)
+                        break
+                if encounters_left <= stall_check_at:
+                    stall_check_at = -1  # once per meal
+                    if not pred_pool.can_eat_any(prey_pool):
+                        return
+        else:  # skip wasted encounters, until the next meal
+            log_wasted_chance = math.log1p(-useful_chance)
+            while encounters_left > 0:
+                encounters_left -= int(math.log(1.0 - draw()) / log_wasted_chance) + 1
+                if encounters_left < 0:  # ran out before reaching an encounter that matters
+                    break
+                prey_selected_name, prey_selected = prey_select(True, rng)  # surviving_only=True
+                pred_spec_selected_name, pred_idx = pred_select(True, rng)  # hungry_only=True
+                if pred_species[pred_spec_selected_name].encounter(pred_idx, prey_selected, r=draw()):
+                    consume(prey_selected_name)
+                    break
+                if encounters_left <= stall_check_at:
+                    stall_check_at = -1  # once per meal
+                    if not pred_pool.can_eat_any(prey_pool):
+                        return
+
+
+# run a single-generation trial and returns results
+def one_gen(prey_in: mim.PreyPool, pred_in: mim.PredatorPool, number_of_encounters: int,
+            rng: random.Random = None) \
+        -> Tuple[mim.PreyPool, mim.PredatorPool]:
+    prey_pool = prey_in.copy()
+    pred_pool = pred_in.copy()
+    _run_gen(prey_pool, pred_pool, number_of_encounters, rng=rng)
     return prey_pool, pred_pool
 
 
 # return only the last generation of a multi-generation trial
 def multi_gen(prey_in: mim.PreyPool, pred_in: mim.PredatorPool, number_of_encounters: int, generations: int = 1,
-              repopulate: bool = False) \
+              repopulate: bool = False, rng: random.Random = None, repopulate_exact: bool = False) \
         -> Tuple[mim.PreyPool, mim.PredatorPool]:
-    prey_pool_current = deepcopy(prey_in)
-    pred_pool_current = deepcopy(pred_in)
+    prey_pool_current = prey_in.copy()
+    pred_pool_current = pred_in.copy()
 
     for _ in range(generations):
-        pred_pool_current = deepcopy(pred_in)
-        prey_pool_current.repopulate()
-
-        prey_pool_current, pred_pool_current = one_gen(prey_pool_current, pred_pool_current, number_of_encounters)
+        pred_pool_current.reset()
+        prey_pool_current.repopulate(exact=repopulate_exact)
+        _run_gen(prey_pool_current, pred_pool_current, number_of_encounters, rng=rng)
 
     if repopulate:
-        prey_pool_current.repopulate()
+        prey_pool_current.repopulate(exact=repopulate_exact)
     return prey_pool_current, pred_pool_current
 
 
 # return iterable over all the generations of a multi-generation trial
+# the same two pools are yielded every generation and updated in place once iteration resumes,
+# so callers wanting to keep a generation's state must copy it first
 def all_gens(prey_in: mim.PreyPool, pred_in: mim.PredatorPool, number_of_encounters: int, generations: int = 1,
-             repopulate: bool = False) \
+             repopulate: bool = False, rng: random.Random = None, repopulate_exact: bool = False) \
         -> Iterable[Tuple[mim.PreyPool, mim.PredatorPool, int]]:
-    prey_pool_current = deepcopy(prey_in)
-    pred_pool_current = deepcopy(pred_in)
+    prey_pool_current = prey_in.copy()
+    pred_pool_current = pred_in.copy()
 
     if repopulate:
         yield prey_pool_current, pred_pool_current, 0
     for g in range(1, generations + 1):
-        prey_pool_current, pred_pool_current = one_gen(prey_pool_current, pred_pool_current, number_of_encounters)
+        _run_gen(prey_pool_current, pred_pool_current, number_of_encounters, rng=rng)
         if repopulate:
-            prey_pool_current.repopulate()
-            pred_pool_current = deepcopy(pred_in)
+            prey_pool_current.repopulate(exact=repopulate_exact)
+            pred_pool_current.reset()
             yield prey_pool_current, pred_pool_current, g
         else:
             yield prey_pool_current, pred_pool_current, g
-            prey_pool_current.repopulate()
-            pred_pool_current = deepcopy(pred_in)
+            prey_pool_current.repopulate(exact=repopulate_exact)
+            pred_pool_current.reset()
 
 
 # Simulation object representing the parameters of one simulation but not its output
 class Simulation:
     def __init__(self, title: str = None, prey_pool: mim.PreyPool = mim.PreyPool(),
                  pred_pool: mim.PredatorPool = mim.PredatorPool(), encounters: int = None, generations: int = None,
-                 repetitions: int = None, repopulate: bool = False):
+                 repetitions: int = None, repopulate: bool = False, seed: int = None, workers: int = None,
+                 repopulate_exact: bool = False):
         self.title = mim.set_with_default(title, '')
         self.prey_pool = prey_pool
         self.pred_pool = pred_pool
         for pred_spec in self.pred_pool.objects:
-            for pred in pred_spec:
-                pred.learn_all(self.prey_pool)
+            pred_spec.learn_all(self.prey_pool)
         self.encounters = mim.set_with_default(encounters, 1, intended_type='int')
         self.generations = mim.set_with_default(generations, 1, intended_type='int')
         self.repetitions = mim.set_with_default(repetitions, 1, intended_type='int')
         self.repopulate = mim.set_with_default(repopulate, False)
+        # whether repopulating keeps the prey total exactly at its original size, rather than rounding each species
+        self.repopulate_exact = mim.set_with_default(repopulate_exact, False)
+        # private random stream when given a seed, so runs can be reproduced by passing one; otherwise None, so that
+        # runs draw from the module-level generator in random and random.seed() still makes them reproducible
+        self.rng = random.Random(seed) if seed is not None else None
+        # processes to run repetitions in; with more than one, each trial gets its own stream seeded from self.rng (or
+        # random), so results are reproducible for a given number of workers but differ from a run in a single process
+        self.workers = mim.set_with_default(workers, 1, intended_type='int')
 
     def __str__(self) -> str:
         return f'<Simulation "{self.title}">'
@@ -103,45 +170,84 @@ class Simulation:
     # run self, return an iterator over (prey_pool, pred_pool, gen)
     def iter_run(self, file_destination: str, verbose: bool = False, output: str = CSV, alt_title: str = None) \
             -> Iterable[Tuple[mim.PreyPool, mim.PredatorPool, int]]:
-        if not file_destination or file_destination[-1] != '/':
-            file_destination += '/'
-        filename = file_destination + (alt_title if alt_title else self.title)
+        if output == NONE:  # file_destination is ignored
+            return ((prey_out, pred_out, gen) for trial, gen, prey_out, pred_out in self.run_raw(verbose=verbose))
+
+        filename = os.path.join(file_destination, alt_title if alt_title else self.title)
         if output == CSV:
             return self._run_csv(filename, verbose=verbose)
         elif output == XML:
             import mimsim.xml_tools as xt
             return xt.write_results(self, filename, verbose=verbose)
-        elif output == NONE:
-            return ((prey_out, pred_out, gen) for trial, gen, prey_out, pred_out in self.run_raw(verbose=verbose))
 
     # run self without writing to any file
     # return an iterator over (trial, gen, prey_pool, pred_pool)
     def run_raw(self, verbose=False) -> Iterable[Tuple[int, int, mim.PreyPool, mim.PredatorPool]]:
-        if verbose:
+        if self.workers > 1 and self.repetitions > 1:
+            yield from self._run_raw_parallel(verbose=verbose)
+        elif verbose:
             for trial in range(1, self.repetitions + 1):
                 for prey_out, pred_out, gen in all_gens(self.prey_pool, self.pred_pool, self.encounters,
-                                                        self.generations, repopulate=self.repopulate):
+                                                        self.generations, repopulate=self.repopulate, rng=self.rng,
+                                                        repopulate_exact=self.repopulate_exact):
                     yield trial, gen, prey_out, pred_out
         else:
             for trial in range(1, self.repetitions + 1):
                 prey_out, pred_out = multi_gen(self.prey_pool, self.pred_pool, self.encounters,
-                                               self.generations, repopulate=self.repopulate)
+                                               self.generations, repopulate=self.repopulate, rng=self.rng,
+                                               repopulate_exact=self.repopulate_exact)
                 yield trial, 1, prey_out, pred_out
 
+    # run_raw, with trials spread across self.workers processes and yielded in order as they finish
+    def _run_raw_parallel(self, verbose=False) -> Iterable[Tuple[int, int, mim.PreyPool, mim.PredatorPool]]:
+        rng = random if self.rng is None else self.rng
+        seeds = [rng.getrandbits(64) for _ in range(self.repetitions)]
+        n = self.repetitions
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=mim._load_phen_ids,
+                                 initargs=(list(mim._phen_names),)) as executor:
+            trial_results = executor.map(_run_trial, [self.prey_pool] * n, [self.pred_pool] * n, [self.encounters] * n,
+                                         [self.generations] * n, [self.repopulate] * n, [self.repopulate_exact] * n,
+                                         [verbose] * n, seeds)
+            for trial, gen_results in enumerate(trial_results, start=1):
+                for gen, prey_out, pred_out in gen_results:
+                    yield trial, gen, prey_out, pred_out
+
     def _run_csv(self, filename: str, verbose: bool = False) \
             -> Iterable[Tuple[mim.PreyPool, mim.PredatorPool, int]]:
         prey_names = self.prey_pool.names
         headers = (['trial', 'generation'] * verbose) + [species + ' popu' for species in prey_names]
-        with open(filename + '.csv', 'w', newline='') as data:
-            writer = csv.DictWriter(data, fieldnames=headers)
-            writer.writeheader()
-            trial_rows = self.run_raw(verbose=verbose)
-            for trial, gen, prey_out, pred_out in trial_rows:
-                yield prey_out, pred_out, gen
-                this_row = {species + ' popu': prey_out.popu(species) for species in prey_names}
-                if verbose:
-                    this_row.update({'trial': trial, 'generation': gen})
-                writer.writerow(this_row)
+        with open(filename + '.csv', 'w', newline='', buffering=_CSV_BUFFER_SIZE) as data:
+            writer = csv.writer(data)
+            writer.writerow(headers)  # species names may need quoting, but every value after this is a plain int
+            row_format = ','.join(['{}'] * len(headers)) + writer.dialect.lineterminator
+            batch = []
+            try:
+                trial_rows = self.run_raw(verbose=verbose)
+                for trial, gen, prey_out, pred_out in trial_rows:
+                    yield prey_out, pred_out, gen
+                    values = [trial, gen] if verbose else []
+                    values += [prey_obj.popu for prey_obj in prey_out.objects]  # in name order, as in headers
+                    batch.append(row_format.format(*values))
+                    if len(batch) >= _CSV_BATCH_ROWS:
+                        data.write(''.join(batch))
+                        batch.clear()
+            finally:  # write out any partial batch, including when the caller stops iterating early
+                data.write(''.join(batch))
+
+
+# run one trial in a worker process, returning what run_raw yields for it as a list of (gen, prey_pool, pred_pool)
+def _run_trial(prey_in: mim.PreyPool, pred_in: mim.PredatorPool, encounters: int, generations: int, repopulate: bool,
+               repopulate_exact: bool, verbose: bool, seed: int) -> List[Tuple[int, mim.PreyPool, mim.PredatorPool]]:
+    rng = random.Random(seed)
+    if verbose:  # all_gens updates the same pools in place, so each generation is copied before it is sent back
+        return [(gen, prey_out.copy(), pred_out.copy())
+                for prey_out, pred_out, gen in all_gens(prey_in, pred_in, encounters, generations,
+                                                        repopulate=repopulate, rng=rng,
+                                                        repopulate_exact=repopulate_exact)]
+    else:
+        prey_out, pred_out = multi_gen(prey_in, pred_in, encounters, generations, repopulate=repopulate, rng=rng,
+                                       repopulate_exact=repopulate_exact)
+        return [(1, prey_out, pred_out)]
 
 
 # run each Simulation in an Iterable[Simulation] with no return value
@@ -3,11 +3,15 @@ Prey and Predator classes for use in simulating predation, mimicry, etc.
 """
 
 import bisect
+import itertools
+import math
+import operator
 import random
-import statistics
 import sys
-from typing import NoReturn, Union, Iterable, Tuple, List
-from copy import copy, deepcopy
+from collections import deque
+from types import MappingProxyType
+from typing import NoReturn, Union, Iterable, Tuple, List, Mapping
+from copy import copy
 
 # TODO: Let predator hunger and prey size influence likelihood of eating per encounter
 
@@ -18,69 +22,161 @@ from copy import copy, deepcopy
 
 # TODO: Allow partial phenotype resemblance
 
+_MAXSIZE = sys.maxsize  # appetite or memory standing in for unlimited
+_ALIAS_MIN_SPECIES = 8  # pools with fewer prey species than this are sampled with a plain linear scan
+_ALIAS_REBUILD_RATIO = 2  # PreyPool.select rebuilds its alias table once surviving popu falls below 1/this of build
+_ALIAS_MAX_REJECTIONS = 64  # rejections in a row after which PreyPool.select recounts; each accepts with chance >= 1/2
+
+# Methods that draw random numbers take an optional rng (a random.Random instance) and fall back to the module-level
+# generator in random when it is None, so random.seed() still controls any run made without an explicit rng.
+
+# fields shown by Prey.string(), with getters fetching all of them in one call
+_PREY_FIELDS = ('popu', 'phen', 'size', 'camo', 'pal')
+_PREY_FIELDS_FULL = ('popu', 'popu_orig', 'phen', 'size', 'camo', 'pal')
+_get_prey_fields = operator.attrgetter(*_PREY_FIELDS)
+_get_prey_fields_full = operator.attrgetter(*_PREY_FIELDS_FULL)
+
 
 # Prey object representing a species of prey
+# setting popu or popu_orig keeps the totals of the PreyPool holding the species current; a species can be in only one
+# pool at a time, so add a copy to each pool instead, which starts out in none
 class Prey:
+    __slots__ = ('_phen', 'phen_id', '_camo', '_see_prob', '_pal', '_log_pal', '_experience', 'size', '_popu_orig',
+                 '_popu', '_pool')
+
     def __init__(self, popu: int = None, phen: str = None, size: float = None, camo: float = None, pal: float = None):
+        self._pool = None
         self.phen = set_with_default(phen, '', 'str')
         self.camo = set_with_default(camo, 0.0, 'float')
         self.pal = set_with_default(pal, 1.0, 'float')
         self.size = set_with_default(size, 1.0, 'float')
-        self.popu_orig = set_with_default(popu, 0, 'int')
-        self.popu = self.popu_orig
+        self._popu_orig = set_with_default(popu, 0, 'int')
+        self._popu = self._popu_orig
 
-        if not 0 <= self.pal <= 1:
-            raise ValueError('Palatability must be between 0 and 1 inclusive')
+    def __str__(self) -> str:
+        return self.string()
+
+    def __copy__(self) -> 'Prey':
+        prey_obj = Prey.__new__(Prey)
+        for slot in Prey.__slots__:
+            setattr(prey_obj, slot, getattr(self, slot))
+        prey_obj._pool = None
+        return prey_obj
 
-        if not 0 <= self.pal <= 1:
+    # every field but _pool is an immutable scalar, so a deep copy is the same as a shallow one
+    def __deepcopy__(self, memo: dict) -> 'Prey':
+        return self.__copy__()
+
+    @property
+    def popu(self) -> int:
+        return self._popu
+
+    @popu.setter
+    def popu(self, value: int) -> NoReturn:
+        if self._pool is not None:
+            self._pool._popu_changed(value - self._popu)
+        self._popu = value
+
+    @property
+    def popu_orig(self) -> int:
+        return self._popu_orig
+
+    @popu_orig.setter
+    def popu_orig(self, value: int) -> NoReturn:
+        if self._pool is not None:
+            self._pool._popu_orig_sum += value - self._popu_orig
+        self._popu_orig = value
+
+    @property
+    def camo(self) -> float:
+        return self._camo
+
+    @camo.setter
+    def camo(self, value: float) -> NoReturn:
+        if not 0 <= value <= 1:
             raise ValueError('Camo must be between 0 and 1 inclusive')
+        self._camo = value
+        self._see_prob = 1 - value  # chance that a predator sees this prey on encounter
 
-    def __str__(self) -> str:
-        return self.string()
+    @property
+    def pal(self) -> float:
+        return self._pal
+
+    @pal.setter
+    def pal(self, value: float) -> NoReturn:
+        if not 0 <= value <= 1:
+            raise ValueError('Palatability must be between 0 and 1 inclusive')
+        self._pal = value
+        self._log_pal = math.log(value) if value > 0 else -math.inf
+        self._experience = (value, self._log_pal)  # shared by every memory of eating this prey, so log is taken once
+
+    @property
+    def phen(self) -> str:
+        return self._phen
+
+    @phen.setter
+    def phen(self, value: str) -> NoReturn:
+        self._phen = value
+        self.phen_id = _phen_id(value)  # interned id, so predators never need to hash the phenotype string
 
     def string(self, full: bool = False) -> str:
-        fields = ['popu', 'popu_orig', 'phen', 'size', 'camo', 'pal'] if full \
-            else ['popu', 'phen', 'size', 'camo', 'pal']
-        kv_pairs = []
-        for field in fields:
-            kv_pairs.append(f'{field}={vars(self)[field]}')
-        return '; '.join(kv_pairs)
+        if full:
+            fields, values = _PREY_FIELDS_FULL, _get_prey_fields_full(self)
+        else:
+            fields, values = _PREY_FIELDS, _get_prey_fields(self)
+        return '; '.join(f'{field}={value}' for field, value in zip(fields, values))
 
 
 # PreyPool object representing all of the prey in one ecosystem
 class PreyPool:
     def __init__(self):
-        self._species_names = []  # list of species names only. Always sorted by the end of any method
+        self._sorted = True  # whether _dict is in name order; False after add() until _names() next sorts it
+        self._name_list = None  # names in _dict order, built lazily by _names() and dropped when species change
         self._dict = {}  # dict of name: Prey pairs
+        self._popu_sum = 0  # total surviving popu, kept current by the pool's methods and its species' popu setter
+        self._popu_orig_sum = 0  # total popu_orig
+        self._alias = None  # (prob, alias, popu at build, total at build) for species sampling, built lazily
 
     def __str__(self) -> str:
         return '/'.join(self.pretty_list())
 
     def __iter__(self) -> Iterable[Tuple[str, Prey]]:
-        return ((name, self._dict[name]) for name in self.names)
+        return ((name, self._dict[name]) for name in self._names())
 
     def __len__(self) -> int:
-        return len(self._species_names)
+        return len(self._dict)
     
     def __getitem__(self, item) -> Prey:
         if not isinstance(item, str):
             raise TypeError(f'Species name expected to be str. Instead got {type(item)}')
-        elif item not in self._species_names:
+        elif item not in self._dict:
             raise KeyError(f'No species named "{item}"')
         else:
             return self._dict[item]
 
     @property
-    def dict(self) -> dict:
-        return copy(self._dict)
+    def dict(self) -> Mapping[str, Prey]:  # read-only view; use add, remove or replace to change the pool
+        return MappingProxyType(self._dict)
 
     @property
-    def names(self) -> List[str]:
-        return copy(self._species_names)
+    def names(self) -> Tuple[str, ...]:
+        return tuple(self._names())
 
     @property
     def objects(self) -> List[Prey]:
-        return [self._dict[name] for name in self._species_names]
+        self._names()  # puts _dict in name order
+        return list(self._dict.values())
+
+    # species names in sorted order, re-sorting _dict in place first if any were added since the last call
+    def _names(self) -> List[str]:
+        if self._name_list is None:
+            if not self._sorted:
+                items = sorted(self._dict.items())
+                self._dict.clear()  # refill rather than rebind, so views handed out by dict stay current
+                self._dict.update(items)
+                self._sorted = True
+            self._name_list = list(self._dict)
+        return self._name_list
 
     def add(self, spec_name: str, prey_obj: Prey) -> bool:
         if not isinstance(spec_name, str):
@@ -90,16 +186,27 @@ class PreyPool:
 
         if spec_name in self._dict:
             return False
-        bisect.insort(self._species_names, spec_name)
+        elif prey_obj._pool is not None:
+            raise ValueError(f'Prey for "{spec_name}" is already in a pool; add a copy of it instead')
+        self._sorted = False  # sorted lazily by _names(), so bulk setup doesn't re-sort per species
+        self._name_list = None
         self._dict[spec_name] = prey_obj
+        prey_obj._pool = self
+        self._popu_sum += prey_obj._popu
+        self._popu_orig_sum += prey_obj._popu_orig
+        self._invalidate()
         return True
 
     def remove(self, spec_name: str) -> bool:
         if not isinstance(spec_name, str):
             raise TypeError(f'spec_name must be instance of string. Instead got {type(spec_name)}')
-        if spec_name in self._species_names:
-            self._species_names.remove(spec_name)
-            del self._dict[spec_name]
+        if spec_name in self._dict:
+            self._name_list = None  # popping keeps the remaining species in whatever order they were
+            prey_obj = self._dict.pop(spec_name)
+            prey_obj._pool = None
+            self._popu_sum -= prey_obj._popu
+            self._popu_orig_sum -= prey_obj._popu_orig
+            self._invalidate()
             return True
         return False
 
@@ -108,15 +215,59 @@ class PreyPool:
         self.add(spec_name, spec_obj)
 
     def clear(self) -> NoReturn:
-        self._species_names = []
+        for prey_obj in self._dict.values():
+            prey_obj._pool = None
+        self._sorted = True
+        self._name_list = None
         self._dict = {}
+        self._popu_sum = 0
+        self._popu_orig_sum = 0
+        self._invalidate()
+
+    # return a pool whose populations can change independently of this one
+    # every Prey field is an immutable scalar, so a shallow copy of each species is enough
+    def copy(self) -> 'PreyPool':
+        pool = PreyPool()
+        self._names()  # so the copy starts out sorted too
+        pool._dict = {name: copy(prey_obj) for name, prey_obj in self._dict.items()}
+        for prey_obj in pool._dict.values():
+            prey_obj._pool = pool
+        pool._popu_sum = self._popu_sum
+        pool._popu_orig_sum = self._popu_orig_sum
+        return pool
+
+    # set the surviving population of a species; the same as setting its Prey.popu
+    def set_popu(self, spec_name: str, popu: int) -> NoReturn:
+        self._dict[spec_name].popu = popu
+
+    # remove individuals of a species that have been eaten
+    def consume(self, spec_name: str, count: int = 1) -> NoReturn:
+        self._dict[spec_name]._popu -= count  # past the setter, since the total is updated here directly
+        self._popu_sum -= count
+        # the alias table stays usable, since select accepts each species with chance popu / popu at build
+
+    # called by Prey.popu's setter when one of this pool's species changes population by delta
+    def _popu_changed(self, delta: int) -> NoReturn:
+        self._popu_sum += delta
+        if delta > 0:  # decreases are absorbed by select's acceptance step, as for consume
+            self._invalidate()
+
+    # drop cached data derived from species populations, after any change that could increase one of them
+    def _invalidate(self) -> NoReturn:
+        self._alias = None
+
+    # total the species' populations afresh, for when the cached totals disagree with them
+    def _recount(self) -> NoReturn:
+        self._popu_sum = sum(prey_obj._popu for prey_obj in self._dict.values())
+        self._popu_orig_sum = sum(prey_obj._popu_orig for prey_obj in self._dict.values())
+        self._invalidate()
 
     def _popu_of(self, spec_name: str, surviving_only: bool = True) -> int:
         if not isinstance(spec_name, str):
             raise TypeError(f'spec_name must be instance of string. Instead got {type(spec_name)}')
         elif not isinstance(surviving_only, bool):
             raise TypeError(f'surviving_only must be instance of bool. Instead got {type(surviving_only)}')
-        elif spec_name not in self._species_names:
+        elif spec_name not in self._dict:
             return 0
 
         elif surviving_only:
@@ -127,173 +278,446 @@ class PreyPool:
     def popu(self, spec_name: str = None, surviving_only: bool = True) -> int:
         if spec_name is None:
             if surviving_only:
-                return sum([p.popu for p in self._dict.values()])
+                return self._popu_sum
             else:
-                return sum([p.popu_orig for p in self._dict.values()])
+                return self._popu_orig_sum
         else:
             return self._popu_of(spec_name, surviving_only=surviving_only)
 
-    def repopulate(self, popu_target: int = None) -> NoReturn:
+    # scale surviving populations up or down to total about popu_target, popu_orig's total by default
+    # each species is rounded on its own, so the total can miss the target by a few; with exact=True, the shortfall or
+    # excess is instead settled by largest remainder, ties going in name order, so the total is exactly popu_target
+    # (rounded to a whole number of prey)
+    def repopulate(self, popu_target: int = None, exact: bool = False) -> NoReturn:
         if popu_target is None:
             popu_target = self.popu(surviving_only=False)
         prey_ct_latest = self.popu(surviving_only=True)
+        popu_sum = 0
         if prey_ct_latest == 0:
             for species in self._dict.values():
-                species.popu = 0
+                species._popu = 0
+        elif exact:
+            popu_target = int(round(popu_target))
+            shares = [(species, species._popu * popu_target / prey_ct_latest) for species in self.objects]
+            for species, share in shares:
+                species._popu = math.floor(share)
+                popu_sum += species._popu
+            shares.sort(key=lambda pair: pair[1] - pair[0]._popu, reverse=True)
+            for species, _ in shares[:popu_target - popu_sum]:
+                species._popu += 1
+            popu_sum = popu_target
         else:
             for species in self._dict.values():
-                species.popu = round(species.popu / prey_ct_latest * popu_target)
+                species._popu = round(species._popu / prey_ct_latest * popu_target)
+                popu_sum += species._popu  # totalled as we go rather than in a second pass
+        self._popu_sum = popu_sum
+        self._invalidate()
+
+    # pick a surviving individual at random and return its species
+    # if surviving_only is False, eaten individuals can be picked too, in which case (None, None) is returned
+    def select(self, surviving_only: bool = True, rng: random.Random = None) \
+            -> Union[Tuple[str, Prey], Tuple[None, None]]:
+        rng = random if rng is None else rng
+        if len(self._dict) < _ALIAS_MIN_SPECIES:
+            available_popu = self.popu(surviving_only=surviving_only)
+            if not available_popu:
+                return None, None
+            idx = rng.randrange(available_popu)
+            for species, prey_obj in self:
+                if idx < prey_obj._popu:
+                    return species, prey_obj
+                else:
+                    idx -= prey_obj._popu
+            if surviving_only:  # the cached total exceeds the species' populations, so it must be stale
+                self._recount()
+                return self.select(surviving_only, rng)
+            return None, None
 
-    def select(self, surviving_only: bool = True) -> Union[Tuple[str, Prey], Tuple[None, None]]:
-        available_popu = self.popu(surviving_only=surviving_only)
+        surviving_popu = self.popu(surviving_only=True)
+        available_popu = surviving_popu if surviving_only else self.popu(surviving_only=False)
         if not available_popu:
             return None, None
-        idx = random.randrange(available_popu)
-        for species, prey_obj in self:
-            if idx < prey_obj.popu:
-                return species, self._dict[species]
-            else:
-                idx -= prey_obj.popu
-        return None, None
+        if rng.randrange(available_popu) >= surviving_popu:  # picked an individual that has already been eaten
+            return None, None
+
+        if self._alias is None or surviving_popu * _ALIAS_REBUILD_RATIO < self._alias[3]:
+            self._alias = self._build_alias()
+            if self._alias[3] != surviving_popu:  # the cached total disagrees with the species' populations
+                self._recount()
+                return self.select(surviving_only, rng)
+        prob, alias, built_popu, _ = self._alias
+        names = self._names()
+        # Walker's alias method proposes a species in O(1) in proportion to its popu when the table was built. Keeping
+        # it with chance popu / built popu corrects for meals since then, which is why consume() needn't rebuild.
+        # While the cached total is right, each try is accepted with chance at least 1 / _ALIAS_REBUILD_RATIO, so a long
+        # run of rejections means populations fell behind the pool's back; recounting then rebuilds the table.
+        for _ in range(_ALIAS_MAX_REJECTIONS):
+            k = rng.randrange(len(names))
+            if rng.random() >= prob[k]:
+                k = alias[k]
+            prey_obj = self._dict[names[k]]
+            if rng.random() * built_popu[k] < prey_obj._popu:
+                return names[k], prey_obj
+        self._recount()
+        return self.select(surviving_only, rng)
+
+    # Vose's construction of Walker's alias table over the current populations, in name order
+    def _build_alias(self) -> Tuple[List[float], List[int], List[int], int]:
+        popus = [prey_obj._popu for prey_obj in self.objects]
+        n = len(popus)
+        total = sum(popus)
+        if not total:  # only when the cached total was stale; select recounts before this table is used
+            return [1.0] * n, list(range(n)), popus, total
+        scaled = [popu * n / total for popu in popus]
+        prob = [1.0] * n  # entries left at 1 by rounding in the loop below are never aliased
+        alias = list(range(n))
+        small = [k for k, p in enumerate(scaled) if p < 1]
+        large = [k for k, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            k_small = small.pop()
+            k_large = large.pop()
+            prob[k_small] = scaled[k_small]
+            alias[k_small] = k_large
+            scaled[k_large] -= 1 - scaled[k_small]
+            (small if scaled[k_large] < 1 else large).append(k_large)
+        return prob, alias, popus, total
 
     def pretty_list(self) -> List[str]:
         return [name + ': ' + str(obj) for name, obj in self]
 
 
 class PredatorSpecies:
+    # Per-predator state is stored species-wide as parallel lists (one entry per predator) rather than as a list of
+    # objects, so that resetting or copying a species is a handful of list operations instead of an object-graph walk.
+    # Experiences are kept in one column per phenotype, indexed by the phenotype's id from _phen_id(). Alongside each
+    # column of experiences are columns holding, for each predator, the sum of the logs of its nonzero experiences and
+    # the count of its zero experiences, so that update_pref never has to walk the experiences themselves, and the
+    # resulting preference, so that get_pref is a single lookup between meals.
+
+    # read-only view of a single predator, as returned by PredatorSpecies[i]
     class Pred:
-        def __init__(self):
-            self.prefs = {}  # (phenotype: [experiences]) pairs, where an experience ranges from 0 to 1
-            self.prey_eaten = 0
+        __slots__ = ('_species', '_i')
+
+        def __init__(self, species: 'PredatorSpecies', i: int):
+            self._species = species
+            self._i = i
+
+        @property
+        def prey_eaten(self) -> float:
+            return self._species._eaten[self._i]
 
-        def learn_all(self, prey_pool: PreyPool) -> NoReturn:
-            for species in prey_pool.objects:
-                if species.phen not in self.prefs:
-                    self.prefs[species.phen] = []
+        @property
+        def prefs(self) -> dict:  # (phenotype: [experiences]) pairs, where an experience ranges from 0 to 1
+            return {_phen_names[phen_id]: [pal for pal, _ in column[self._i]]
+                    for phen_id, column in enumerate(self._species._experiences) if column is not None}
+
+    __slots__ = ('popu', '_app', '_mem', 'insatiable', '_eaten', '_hungry', '_hungry_pos', '_experiences', '_log_sums',
+                 '_zero_counts', '_prefs', '_pref_maxes', '_learned')
 
     def __init__(self, popu, prey_types: PreyPool = None, app: int = None, mem: int = None, insatiable: bool = None):
         self.popu = set_with_default(popu, 1, 'int')
-        self.app = set_with_default(app, int(sys.maxsize), 'int')
-        self.mem = set_with_default(mem, int(sys.maxsize), 'int')
+        self._app = set_with_default(app, _MAXSIZE, 'int')  # set directly, since there is no _eaten yet
+        self._mem = set_with_default(mem, _MAXSIZE, 'int')  # set directly, since there are no experiences yet
         self.insatiable = set_with_default(insatiable, True, 'bool')
-        self.rep = self.Pred()
+        self._eaten = [0] * self.popu  # amount eaten by each predator
+        self._hungry = []  # indices of the predators that are still hungry, in no particular order
+        self._hungry_pos = []  # predator index: its position in _hungry, or -1 once full; doubles as the hunger mask
+        self._reset_hungry()
+        # phenotype id: [experiences of each predator], or None where phenotype is unknown. An experience is the
+        # (pal, log(pal)) pair held by the prey that was eaten, so update_pref and get_pref never call math.log
+        self._experiences = []
+        self._log_sums = []  # phenotype id: [sum of log(experience) over nonzero experiences of each predator]
+        self._zero_counts = []  # phenotype id: [number of zero experiences of each predator]
+        self._prefs = []  # phenotype id: [preference of each predator], recomputed by update_pref
+        self._pref_maxes = [1.0] * self.popu  # highest preference of each predator, 1 while any phenotype is unmet
+        self._learned = set()  # ids of phenotypes known from learn_all, which survive reset
         if prey_types is not None:
-            self.rep.learn_all(prey_types)
-        self._lst = [deepcopy(self.rep) for _ in range(popu)]
+            self.learn_all(prey_types)
+
+    @property
+    def app(self) -> int:
+        return self._app
+
+    @app.setter
+    def app(self, value: int) -> NoReturn:
+        self._app = value
+        self._reset_hungry()  # who counts as hungry depends on appetite
+
+    @property
+    def mem(self) -> int:
+        return self._mem
+
+    @mem.setter
+    def mem(self, value: int) -> NoReturn:
+        self._mem = value
+        self._rewindow()  # every memory window is sized by mem
 
     def __getitem__(self, item: int) -> Pred:
-        return self._lst[item]
+        if not -self.popu <= item < self.popu:
+            raise IndexError(f'Predator index {item} out of range for species of {self.popu}')
+        return self.Pred(self, item % self.popu)
 
     def __len__(self) -> int:
-        return len(self._lst)
+        return self.popu
 
     def __str__(self) -> str:
         kv_pairs = []
         for field in ['popu', 'app', 'mem', 'insatiable']:
-            value = vars(self)[field]
-            if value >= int(sys.maxsize):
+            value = getattr(self, field)
+            if value >= _MAXSIZE:
                 value = 'max'
             kv_pairs.append(f'{field}={value}')
         return '; '.join(kv_pairs)
 
-    def eat(self, i: int, prey_item: Prey) -> NoReturn:
-        pred = self[i]
-        if prey_item.phen not in pred.prefs:  # first encounter with phenotype
-            pred.prefs[prey_item.phen] = []
+    # return an independent copy of this species, predator state included
+    def copy(self) -> 'PredatorSpecies':
+        spec = PredatorSpecies.__new__(PredatorSpecies)
+        spec.popu = self.popu
+        spec._app = self._app
+        spec._mem = self._mem
+        spec.insatiable = self.insatiable
+        spec._eaten = list(self._eaten)
+        spec._hungry = list(self._hungry)
+        spec._hungry_pos = list(self._hungry_pos)
+        spec._experiences = [None if column is None else [experiences.copy() for experiences in column]
+                             for column in self._experiences]
+        spec._log_sums = [None if column is None else list(column) for column in self._log_sums]
+        spec._zero_counts = [None if column is None else list(column) for column in self._zero_counts]
+        spec._prefs = [None if column is None else list(column) for column in self._prefs]
+        spec._pref_maxes = list(self._pref_maxes)
+        spec._learned = set(self._learned)
+        return spec
+
+    # make phenotype known to every predator of this species, with no experiences yet
+    def _learn(self, phen_id: int) -> NoReturn:
+        if phen_id >= len(self._experiences):
+            padding = [None] * (phen_id + 1 - len(self._experiences))
+            self._experiences.extend(padding)
+            self._log_sums.extend(padding)
+            self._zero_counts.extend(padding)
+            self._prefs.extend(padding)
+        if self._experiences[phen_id] is None:
+            maxlen = self._maxlen()
+            self._experiences[phen_id] = [deque(maxlen=maxlen) for _ in range(self.popu)]
+            self._log_sums[phen_id] = [0.0] * self.popu
+            self._zero_counts[phen_id] = [0] * self.popu
+            self._prefs[phen_id] = [1.0] * self.popu  # no experiences yet
+            self._pref_maxes = [1.0] * self.popu  # no preference exceeds 1
+
+    # length of each memory window; a memory of 0 has always meant unlimited, since experiences[-0:] kept the whole list
+    def _maxlen(self) -> Union[int, None]:
+        return self._mem if 0 < self._mem < _MAXSIZE else None
+
+    # resize every memory window to the current mem, keeping the most recent experiences, and recompute what is
+    # derived from them as update_pref would have
+    def _rewindow(self) -> NoReturn:
+        maxlen = self._maxlen()
+        resized = False
+        for phen_id, column in enumerate(self._experiences):
+            if column is None:
+                continue
+            log_sums = self._log_sums[phen_id]
+            zero_counts = self._zero_counts[phen_id]
+            prefs = self._prefs[phen_id]
+            for i, experiences in enumerate(column):
+                if experiences.maxlen == maxlen:
+                    continue
+                experiences = column[i] = deque(experiences, maxlen=maxlen)  # drops the oldest that no longer fit
+                resized = True
+                zero_counts[i] = sum(1 for pal, _ in experiences if pal == 0)
+                log_sums[i] = sum(log_pal for pal, log_pal in experiences if pal != 0)
+                if not experiences:
+                    prefs[i] = 1.0
+                elif zero_counts[i]:
+                    prefs[i] = 0.0
+                else:
+                    prefs[i] = math.exp((log_sums[i] + experiences[-1][1]) / (len(experiences) + 1))
+        if resized:
+            self._pref_maxes = [max(column[i] for column in self._prefs if column is not None)
+                                for i in range(self.popu)]
+
+    def learn_all(self, prey_pool: PreyPool) -> NoReturn:
+        for species in prey_pool.objects:
+            self._learn(species.phen_id)
+            self._learned.add(species.phen_id)
 
+    def eat(self, i: int, prey_item: Prey) -> NoReturn:
+        self._learn(prey_item.phen_id)  # no-op unless this is the first encounter with phenotype
         self.update_pref(i, prey_item)
-        pred.prey_eaten += prey_item.size
+        self._eaten[i] += prey_item.size
+        if self._eaten[i] >= self._app and self._hungry_pos[i] >= 0:
+            self._sate(i)
 
-    def encounter(self, i: int, prey_item: Prey) -> bool:  # eat prey or decide not to
-        if not self.hungry(i):
+    # eat prey or decide not to; r is the uniform draw to decide with, taken from rng only if the caller has none
+    def encounter(self, i: int, prey_item: Prey, rng: random.Random = None, r: float = None) -> bool:
+        if self._hungry_pos[i] < 0:  # not hungry; inlined from hungry() since this runs once per encounter
             return False
 
-        pursuit_chance = 1  # chance of encounter
-        pursuit_chance *= (1 - prey_item.camo)  # *(chance that prey is seen)
-        pursuit_chance *= self.get_pref(i, prey_item.phen)  # *(chance that prey is sufficiently appetizing)
-
-        # if not self.insatiable:
-        #     size = prey_item.size
-        #     if size > self.app - self.prey_eaten:
-        #         size = self.app - self.prey_eaten
-        #     pursuit_chance *= \
-        #         size * ((self.app - self.prey_eaten) / self.app ** 2)  # *(chance that prey is sufficiently filling)
+        # (chance that prey is seen) * (chance that prey is sufficiently appetizing)
+        pursuit_chance = prey_item._see_prob * self._get_pref(i, prey_item.phen_id)
 
-        # print(pursuit_chance)
-        if pursuit_chance >= random.random():
+        if r is None:
+            r = (rng or random).random()
+        if pursuit_chance >= r:
             self.eat(i, prey_item)
             return True
         else:  # decide not to eat
             return False
 
     def update_pref(self, i: int, prey_item: Prey) -> NoReturn:
-        pred = self[i]
-        phen = prey_item.phen
-        pal = prey_item.pal
-        pred.prefs[phen].append(pal)  # add on most recent experience
-        if len(pred.prefs[phen]) > self.mem:  # remove any experiences too old to remember
-            pred.prefs[phen] = pred.prefs[phen][-self.mem:]
+        phen_id = prey_item.phen_id
+        experiences = self._experiences[phen_id][i]
+        log_sums = self._log_sums[phen_id]
+        zero_counts = self._zero_counts[phen_id]
+
+        if len(experiences) == experiences.maxlen:  # oldest experience is about to be forgotten by the append below
+            pal, log_pal = experiences[0]
+            if pal == 0:
+                zero_counts[i] -= 1
+            else:
+                log_sums[i] -= log_pal
+
+        experiences.append(prey_item._experience)  # add on most recent experience
+        if prey_item._pal == 0:
+            zero_counts[i] += 1
+        else:
+            log_sums[i] += prey_item._log_pal
+
+        prefs = self._prefs[phen_id]
+        pref_old = prefs[i]
+        if zero_counts[i]:
+            prefs[i] = 0.0
+        else:  # geometric mean of the experiences, with the most recent one counted twice
+            prefs[i] = math.exp((log_sums[i] + prey_item._log_pal) / (len(experiences) + 1))
+
+        if prefs[i] >= self._pref_maxes[i]:
+            self._pref_maxes[i] = prefs[i]
+        elif pref_old == self._pref_maxes[i]:  # the favourite just fell, so look for the new one
+            self._pref_maxes[i] = max(column[i] for column in self._prefs if column is not None)
 
     def get_pref(self, i: int, phen: str) -> float:
-        pred = self[i]
-        if phen not in pred.prefs:
+        phen_id = _phen_ids.get(phen)
+        if phen_id is None:
             return 1
+        return self._get_pref(i, phen_id)
 
-        experiences = pred.prefs[phen]
-        if not experiences:
+    def _get_pref(self, i: int, phen_id: int) -> float:
+        if phen_id >= len(self._prefs) or self._prefs[phen_id] is None:
             return 1
-        elif 0 in pred.prefs[phen]:
-            return 0
-        else:
-            return statistics.geometric_mean(experiences + [experiences[-1]])
+        return self._prefs[phen_id][i]
 
     def pref_max(self, i: int) -> float:
-        return max([self.get_pref(i, ph) for ph in self[i].prefs])
+        return self._pref_maxes[i]
 
     def hungry(self, i: int) -> bool:
-        return self[i].prey_eaten < self.app
+        return self._hungry_pos[i] >= 0
+
+    # whether any hungry predator of this species has a nonzero preference for any of the given phenotypes
+    def would_eat_any(self, phen_ids: Iterable[int]) -> bool:
+        for phen_id in phen_ids:
+            if phen_id >= len(self._prefs) or self._prefs[phen_id] is None:  # never met, so preference is 1
+                if self._hungry:
+                    return True
+            else:
+                prefs = self._prefs[phen_id]
+                if any(prefs[i] > 0 for i in self._hungry):
+                    return True
+        return False
 
+    # number of predators of this species that are still hungry
+    def popu_hungry(self) -> int:
+        return len(self._hungry)
+
+    # index of the k-th hungry predator, for 0 <= k < popu_hungry(); the ordering is arbitrary but fixed between meals
+    def hungry_index(self, k: int) -> int:
+        return self._hungry[k]
+
+    # drop predator i from the hungry list by moving the last hungry predator into its place
+    def _sate(self, i: int) -> NoReturn:
+        pos = self._hungry_pos[i]
+        last = self._hungry.pop()
+        if last != i:
+            self._hungry[pos] = last
+            self._hungry_pos[last] = pos
+        self._hungry_pos[i] = -1
+
+    # rebuild the hungry list and mask from scratch, after _eaten is reset or appetite changes
+    def _reset_hungry(self) -> NoReturn:
+        app = self._app
+        self._hungry = [i for i, eaten in enumerate(self._eaten) if eaten < app]
+        self._hungry_pos = [-1] * self.popu
+        for pos, i in enumerate(self._hungry):
+            self._hungry_pos[i] = pos
+
+    # restore every predator to its state right after learn_all, forgetting phenotypes met since
     def reset(self) -> NoReturn:
-        for pred in self._lst:
-            for phen in pred.prefs:
-                pred.prefs[phen] = []
-            pred.prey_eaten = 0
+        self._eaten = [0] * self.popu
+        self._reset_hungry()
+        self._pref_maxes = [1.0] * self.popu
+        for phen_id, column in enumerate(self._experiences):
+            if column is None:
+                continue
+            elif phen_id in self._learned:  # emptied in place, so no deques are rebuilt between generations
+                for experiences in column:
+                    experiences.clear()
+                self._log_sums[phen_id] = [0.0] * self.popu
+                self._zero_counts[phen_id] = [0] * self.popu
+                self._prefs[phen_id] = [1.0] * self.popu
+            else:
+                self._experiences[phen_id] = None
+                self._log_sums[phen_id] = None
+                self._zero_counts[phen_id] = None
+                self._prefs[phen_id] = None
 
 
 # PredatorPool object representing all of the predators in one ecosystem
 class PredatorPool:
     def __init__(self):
-        self._species_names = []  # list of species names only. Always sorted by the end of any method
+        self._sorted = True  # whether _dict is in name order; False after add() until _names() next sorts it
+        self._name_list = None  # names in _dict order, built lazily by _names() and dropped when species change
+        self._cum_popu = None  # running totals of species popu in name order, built lazily alongside _name_list
         self._dict = {}  # dict of name: list<Predator> pairs
 
     def __str__(self) -> str:
         return '/'.join(self.pretty_list())
 
     def __iter__(self) -> Iterable[Tuple[str, PredatorSpecies]]:
-        return ((name, self._dict[name]) for name in self.names)
+        return ((name, self._dict[name]) for name in self._names())
 
     def __len__(self) -> int:
-        return len(self._species_names)
+        return len(self._dict)
 
     def __getitem__(self, item) -> PredatorSpecies:
         if not isinstance(item, str):
             raise TypeError(f'Species name expected to be str. Instead got {type(item)}')
-        elif item not in self._species_names:
+        elif item not in self._dict:
             raise ValueError(f'No species named "{item}"')
         else:
             return self._dict[item]
 
     @property
-    def dict(self) -> dict:
-        return copy(self._dict)
+    def dict(self) -> Mapping[str, PredatorSpecies]:  # read-only view; use add, remove or replace to change the pool
+        return MappingProxyType(self._dict)
     
     @property
-    def names(self) -> List[str]:
-        return copy(self._species_names)
+    def names(self) -> Tuple[str, ...]:
+        return tuple(self._names())
 
     @property
     def objects(self) -> List[PredatorSpecies]:
-        return [self._dict[name] for name in self._species_names]
+        self._names()  # puts _dict in name order
+        return list(self._dict.values())
+
+    # species names in sorted order, re-sorting _dict in place first if any were added since the last call
+    def _names(self) -> List[str]:
+        if self._name_list is None:
+            if not self._sorted:
+                items = sorted(self._dict.items())
+                self._dict.clear()  # refill rather than rebind, so views handed out by dict stay current
+                self._dict.update(items)
+                self._sorted = True
+            self._name_list = list(self._dict)
+        return self._name_list
 
     def add(self, spec_name: str, pred_spec: PredatorSpecies) -> bool:
         if not isinstance(spec_name, str):
@@ -303,15 +727,18 @@ class PredatorPool:
 
         if spec_name in self._dict:
             return False
-        bisect.insort(self._species_names, spec_name)
-        self._dict[spec_name] = deepcopy(pred_spec)
+        self._sorted = False  # sorted lazily by _names(), so bulk setup doesn't re-sort per species
+        self._name_list = None
+        self._cum_popu = None
+        self._dict[spec_name] = pred_spec.copy()
         return True
 
     def remove(self, spec_name: str) -> bool:
         if not isinstance(spec_name, str):
             raise TypeError(f'spec_name must be instance of string. Instead got {type(spec_name)}')
-        if spec_name in self._species_names:
-            self._species_names.remove(spec_name)
+        if spec_name in self._dict:
+            self._name_list = None  # popping keeps the remaining species in whatever order they were
+            self._cum_popu = None
             del self._dict[spec_name]
             return True
         return False
@@ -321,42 +748,63 @@ class PredatorPool:
         self.add(spec_name, pred_spec)
 
     def clear(self) -> NoReturn:
-        self._species_names = []
+        self._sorted = True
+        self._name_list = None
+        self._cum_popu = None
         self._dict = {}
 
+    # return a pool whose predators can eat and learn independently of this one
+    def copy(self) -> 'PredatorPool':
+        pool = PredatorPool()
+        self._names()  # so the copy starts out sorted too
+        pool._dict = {name: pred_spec.copy() for name, pred_spec in self._dict.items()}
+        return pool
+
     def _popu_of(self, spec_name: str, hungry_only=False) -> int:
         if not isinstance(spec_name, str):
             raise TypeError(f'spec_name must be instance of string. Instead got {type(spec_name)}')
         elif not isinstance(hungry_only, bool):
             raise TypeError(f'hungry_only must be instance of bool. Instead got {type(hungry_only)}')
-        elif spec_name not in self._species_names:
+        elif spec_name not in self._dict:
             return 0
         elif hungry_only:
-            return sum(self._dict[spec_name].hungry(i) for i in range(len(self._dict[spec_name])))
+            return self._dict[spec_name].popu_hungry()
         else:
             return len(self._dict[spec_name])
 
+    # running totals of species popu in name order; species sizes are fixed, so only add and remove go stale
+    def _cum_sizes(self) -> List[int]:
+        if self._cum_popu is None or self._name_list is None:
+            self._cum_popu = list(itertools.accumulate(len(self._dict[name]) for name in self._names()))
+        return self._cum_popu
+
     def popu(self, spec_name: str = None, hungry_only: bool = False) -> int:
         if spec_name is None:
-            return sum(self._popu_of(species, hungry_only=hungry_only) for species in self._species_names)
+            if not hungry_only:
+                cum_popu = self._cum_sizes()
+                return cum_popu[-1] if cum_popu else 0
+            return sum(self._popu_of(species, hungry_only=hungry_only) for species in self._dict)
         else:
             return self._popu_of(spec_name, hungry_only=hungry_only)
 
-    def select(self, hungry_only: bool = False) -> Union[Tuple[str, int], Tuple[None, None]]:
-        available_popu = self.popu(hungry_only=hungry_only)
-        if not available_popu:
+    def select(self, hungry_only: bool = False, rng: random.Random = None) -> Union[Tuple[str, int], Tuple[None, None]]:
+        names = self._names()
+        if hungry_only:  # hungry counts change with every meal, so they are totalled afresh in one pass
+            cum_popu = list(itertools.accumulate(self._dict[name].popu_hungry() for name in names))
+        else:  # species sizes are fixed, so their totals are cached
+            cum_popu = self._cum_sizes()
+        if not cum_popu or not cum_popu[-1]:
             return None, None
-        idx = random.randrange(available_popu)
-        for species_name in self.names:
-            if idx < self._popu_of(species_name, hungry_only=hungry_only):
-                if hungry_only:
-                    return species_name, [i for i in range(self._popu_of(species_name))
-                                          if self._dict[species_name].hungry(i)][idx]
-                else:
-                    return species_name, idx
-            else:
-                idx -= self._popu_of(species_name, hungry_only=hungry_only)
-        return None, None
+        idx = (rng or random).randrange(cum_popu[-1])
+        k = bisect.bisect_right(cum_popu, idx)
+        if k:
+            idx -= cum_popu[k - 1]
+        return names[k], self._dict[names[k]].hungry_index(idx) if hungry_only else idx
+
+    # whether any hungry predator could still eat any surviving prey, i.e. would pursue it with nonzero chance
+    def can_eat_any(self, prey_pool: PreyPool) -> bool:
+        phen_ids = {prey_obj.phen_id for prey_obj in prey_pool.objects if prey_obj.popu > 0 and prey_obj.camo < 1}
+        return any(pred_spec.would_eat_any(phen_ids) for pred_spec in self._dict.values())
 
     def pretty_list(self) -> List[str]:
         return [name + ': ' + str(obj) for name, obj in self]
@@ -366,25 +814,52 @@ class PredatorPool:
             pred_spec.reset()
 
 
+# every phenotype string seen so far is given a small integer id, shared by all predator species
+_phen_ids = {}  # phenotype: id
+_phen_names = []  # id: phenotype
+
+
+def _phen_id(phen: str) -> int:
+    phen_id = _phen_ids.get(phen)
+    if phen_id is None:
+        phen_id = _phen_ids[phen] = len(_phen_names)
+        _phen_names.append(phen)
+    return phen_id
+
+
+# intern phenotypes in id order, as in a worker process that must agree with the ids of pools pickled by its parent
+def _load_phen_ids(phen_names: List[str]) -> NoReturn:
+    for phen_id, phen in enumerate(phen_names):
+        if _phen_id(phen) != phen_id:
+            raise RuntimeError(f'Phenotype "{phen}" was already interned with a different id')
+
+
+# casts used by set_with_default, built once rather than on every call
+_CAST = {
+    'int': lambda x: int(float(x)),
+    int: lambda x: int(float(x)),
+    'float': float,
+    float: float,
+    'str': str,
+    str: str,
+    'bool': bool,
+    bool: bool,
+    'dict': dict,
+    dict: dict,
+    'unspecified': lambda x: x
+}
+# intended types whose values are passed through untouched when they already have exactly that type
+_CAST_TYPES = {'int': int, int: int, 'float': float, float: float, 'str': str, str: str, 'bool': bool, bool: bool}
+
+
 def set_with_default(param_in, default_val, intended_type='unspecified'):
-    cast = {
-        'int': lambda x: int(float(x)),
-        int: lambda x: int(float(x)),
-        'float': float,
-        float: float,
-        'str': str,
-        str: str,
-        'bool': bool,
-        bool: bool,
-        'dict': dict,
-        dict: dict,
-        'unspecified': lambda x: x
-    }
     if param_in is None or (intended_type != 'str' and param_in == ''):
         return default_val
+    elif type(param_in) is _CAST_TYPES.get(intended_type):  # as when built from code rather than from text
+        return param_in
     else:
         try:
-            return cast[intended_type](param_in)
+            return _CAST[intended_type](param_in)
         except ValueError:
             raise ValueError(f'Could not cast {type(param_in)} to type "{intended_type}"')
             # print(f'Could not cast "{param_in}" to {intended_type}; Used default value of {default_val}')
@@ -2,30 +2,44 @@
 Utilities for reading/writing simulations and their results from/to *.simu.xml files
 
 validate_sim(tree) -> bool
-load_prey_pool(file_path_in) -> mim.PreyPool
-load_pred_pool(file_path_in) -> mim.PredatorPool
-load_sim(file_path_in) -> mc.Simulation
-write_desc(path, sim) -> None
-write_results(sim, filename, verbose=False) -> None
+load_prey_pool(file_path_in, validate=True) -> mim.PreyPool
+load_pred_pool(file_path_in, validate=True) -> mim.PredatorPool
+load_sim(file_path_in, validate=True) -> mc.Simulation
+write_desc(sim, destination_folder, alt_title=None, pretty_print=True) -> None
+write_results(sim, filename, verbose=False, pretty_print=False) -> None
 """
 
 # builtin or external imports
+import os
+from contextlib import contextmanager
+from functools import lru_cache
 import lxml.etree as et
-from typing import NoReturn, Tuple, Iterable
+from typing import NoReturn, Tuple, Iterable, List
+from xml.sax.saxutils import escape
 # imports from this package
 from mimsim import controller as mc
 from mimsim import mimicry as mim
 
 
+# one parser for every file read; dropping indentation whitespace leaves fewer nodes to walk past
+_PARSER = et.XMLParser(remove_blank_text=True, collect_ids=False, resolve_entities=False)
+
+_XML_BUFFER_SIZE = 1 << 20  # bytes buffered by the output file before each write() to disk
+
+# schemas live beside this module, so they are found whatever the working directory
+_RSC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rsc')
+
+
+# return the compiled schema in the given rsc file, parsing it only the first time it is asked for
+@lru_cache(maxsize=None)
+def _schema(file_name: str) -> et.XMLSchema:
+    return et.XMLSchema(et.parse(os.path.join(_RSC_DIR, file_name), parser=_PARSER))
+
+
 # return true if tree is a valid simulation, otherwise raise AssertionError
 def validate_sim(tree: et.ElementTree, allow_desc: bool = True, allow_output: bool = True) -> bool:
-    desc_schema_src = et.parse('../mimsim/rsc/desc_specification.xsd')
-    desc_schema = et.XMLSchema(desc_schema_src)
-    desc_valid = desc_schema.validate(tree)
-
-    output_schema_src = et.parse('../mimsim/rsc/output_specification.xsd')
-    output_schema = et.XMLSchema(output_schema_src)
-    output_valid = output_schema.validate(tree)
+    desc_valid = _schema('desc_specification.xsd').validate(tree)
+    output_valid = _schema('output_specification.xsd').validate(tree)
 
     if not allow_desc:
         assert not desc_valid, 'File is a valid simulation description file; forbidden by flag desc_ok=False'
@@ -36,157 +50,274 @@ def validate_sim(tree: et.ElementTree, allow_desc: bool = True, allow_output: bo
     return True
 
 
-def _prey_from_root(root: et.Element) -> mim.PreyPool:
-    prey_pool = mim.PreyPool()
-    prey_root = root.find('prey_pool')
-    for species in prey_root:
-        prey_pool.add(
-            species.find('spec_name').text,
-            mim.Prey(popu=int(species.find('popu').text), phen=species.find('phen').text,
-                     size=float(species.find('size').text), camo=float(species.find('camo').text),
-                     pal=float(species.find('pal').text))
+_TRUE_STRS = frozenset(('true', '1'))  # the xs:boolean spellings of True
+
+
+# add the species described by a <prey_spec> element to prey_pool
+# its fields are read in one pass over its children (the schema allows them in any order)
+def _add_prey(prey_pool: mim.PreyPool, species: et.Element) -> NoReturn:
+    fields = {child.tag: child.text for child in species if isinstance(child.tag, str)}  # skips comments and PIs
+    prey_pool.add(
+        fields['spec_name'],
+        mim.Prey(popu=int(fields['popu']), phen=fields['phen'],
+                 size=float(fields['size']), camo=float(fields['camo']),
+                 pal=float(fields['pal']))
+    )
+
+
+# add the species described by a <pred_spec> element to pred_pool
+# its fields are read in one pass over its children (the schema allows them in any order)
+def _add_pred(pred_pool: mim.PredatorPool, species: et.Element) -> NoReturn:
+    fields = {child.tag: child.text for child in species if isinstance(child.tag, str)}  # skips comments and PIs
+    pred_pool.add(
+        fields['spec_name'],
+        mim.PredatorSpecies(
+            app=int(fields['app']),
+            mem=int(fields['mem']),
+            insatiable=fields['insatiable'] in _TRUE_STRS,
+            popu=int(fields['popu'])
         )
-    return prey_pool
+    )
 
 
-# return the prey pool described in a given .simu.xml file
-def load_prey_pool(file_path_in: str) -> mim.PreyPool:
-    sim_tree = et.parse(file_path_in)
-    validate_sim(sim_tree)
-    root = sim_tree.getroot()
-    return _prey_from_root(root)
+def _prey_from_root(root: et.Element) -> mim.PreyPool:
+    prey_pool = mim.PreyPool()
+    for species in root.find('prey_pool'):
+        _add_prey(prey_pool, species)
+    return prey_pool
 
 
 def _pred_from_root(root: et.Element) -> mim.PredatorPool:
     pred_pool = mim.PredatorPool()
-    prey_root = root.find('pred_pool')
-    for species in prey_root:
-        pred_pool.add(
-            species.find('spec_name').text,
-            mim.PredatorSpecies(
-                app=int(species.find('app').text),
-                mem=int(species.find('mem').text),
-                insatiable=bool(species.find('insatiable').text in ('true', '1')),
-                popu=int(species.find('popu').text)
-            )
-        )
+    for species in root.find('pred_pool'):
+        _add_pred(pred_pool, species)
     return pred_pool
 
 
-# return the predator pool described in a given .simu.xml file
-def load_pred_pool(file_path_in: str) -> mim.PredatorPool:
-    sim_tree = et.parse(file_path_in)
-    validate_sim(sim_tree)
-    root = sim_tree.getroot()
-    return _pred_from_root(root)
+# converter from text for each child of <params>, which share their names with Simulation's arguments
+_PARAM_CAST = {
+    'title': lambda text: text,  # already a str, or None if empty, which Simulation replaces with its default
+    'encounters': int,
+    'generations': int,
+    'repetitions': int,
+    'repopulate': _TRUE_STRS.__contains__,
+}
 
 
-# return the Simulation described in a given .simu.xml file
-def load_sim(file_path_in: str) -> mc.Simulation:
-    sim_tree = et.parse(file_path_in)
+# the Simulation arguments given by a <params> element, converted to their types in one pass
+def _read_params(params: et.Element) -> dict:
+    return {child.tag: _PARAM_CAST[child.tag](child.text) for child in params
+            if isinstance(child.tag, str)}  # skips comments and processing instructions
+
+
+# read the params, prey pool and predator pool of a .simu.xml file without holding its whole tree in memory
+# each species (and each trial of results) is discarded as soon as it has been read
+def _iter_load(file_path_in: str) -> Tuple[dict, mim.PreyPool, mim.PredatorPool]:
+    params = dict()
+    prey_pool = mim.PreyPool()
+    pred_pool = mim.PredatorPool()
+    for _, elem in et.iterparse(file_path_in, events=('end',), tag=('params', 'prey_spec', 'pred_spec', 'trial'),
+                                remove_blank_text=True, collect_ids=False, resolve_entities=False):
+        if elem.tag == 'prey_spec':
+            _add_prey(prey_pool, elem)
+        elif elem.tag == 'pred_spec':
+            _add_pred(pred_pool, elem)
+        elif elem.tag == 'params':
+            params = _read_params(elem)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    return params, prey_pool, pred_pool
+
+
+# return the prey pool described in a given .simu.xml file
+# validate=False skips the schema check, for files known to be good (e.g. ones this package just wrote)
+def load_prey_pool(file_path_in: str, validate: bool = True) -> mim.PreyPool:
+    if not validate:
+        return _iter_load(file_path_in)[1]
+    sim_tree = et.parse(file_path_in, parser=_PARSER)
     validate_sim(sim_tree)
-    root = sim_tree.getroot()
-    params = {elem.tag: elem.text for elem in root.find('params')}
-    prey_pool = _prey_from_root(root)
-    pred_pool = _pred_from_root(root)
-    return mc.Simulation(
-        title=params['title'],
-        encounters=int(params['encounters']),
-        generations=int(params['generations']),
-        repetitions=int(params['repetitions']),
-        repopulate=(params['repopulate'] in ('true', '1')),
-        prey_pool=prey_pool,
-        pred_pool=pred_pool
-    )
+    return _prey_from_root(sim_tree.getroot())
 
 
-def _build_desc(sim: mc.Simulation) -> et.ElementTree:
-    root = et.Element('simulation')
+# return the predator pool described in a given .simu.xml file
+# validate=False skips the schema check, for files known to be good (e.g. ones this package just wrote)
+def load_pred_pool(file_path_in: str, validate: bool = True) -> mim.PredatorPool:
+    if not validate:
+        return _iter_load(file_path_in)[2]
+    sim_tree = et.parse(file_path_in, parser=_PARSER)
+    validate_sim(sim_tree)
+    return _pred_from_root(sim_tree.getroot())
 
-    params = et.SubElement(root, 'params')
-    et.SubElement(params, 'title').text = sim.title
-    et.SubElement(params, 'encounters').text = str(sim.encounters)
-    et.SubElement(params, 'generations').text = str(sim.generations)
-    et.SubElement(params, 'repetitions').text = str(sim.repetitions)
-    et.SubElement(params, 'repopulate').text = str(int(sim.repopulate))
 
-    prey_pool = et.SubElement(root, 'prey_pool')
+# return the Simulation described in a given .simu.xml file
+# validate=False skips the schema check, for files known to be good (e.g. ones this package just wrote)
+def load_sim(file_path_in: str, validate: bool = True) -> mc.Simulation:
+    if validate:
+        sim_tree = et.parse(file_path_in, parser=_PARSER)
+        validate_sim(sim_tree)
+        root = sim_tree.getroot()
+        params = _read_params(root.find('params'))
+        prey_pool = _prey_from_root(root)
+        pred_pool = _pred_from_root(root)
+    else:
+        params, prey_pool, pred_pool = _iter_load(file_path_in)
+    return mc.Simulation(**params, prey_pool=prey_pool, pred_pool=pred_pool)
+
+
+# the description has a fixed layout, so it is formatted as one string and parsed in a single call
+_PARAMS_TMPL = ('<params><title>{title}</title><encounters>{encounters}</encounters>'
+                '<generations>{generations}</generations><repetitions>{repetitions}</repetitions>'
+                '<repopulate>{repopulate}</repopulate></params>')
+_PREY_SPEC_TMPL = ('<prey_spec><spec_name>{name}</spec_name><popu>{popu}</popu><phen>{phen}</phen>'
+                   '<size>{size}</size><camo>{camo}</camo><pal>{pal}</pal></prey_spec>')
+_PRED_SPEC_TMPL = ('<pred_spec><spec_name>{name}</spec_name><popu>{popu}</popu><app>{app}</app><mem>{mem}</mem>'
+                   '<insatiable>{insatiable}</insatiable></pred_spec>')
+_BOOL01 = ('0', '1')  # xs:boolean text of False, True
+_XML_DECLARATION = b"<?xml version='1.0' encoding='ASCII'?>\n"
+
+
+# the serialized, unindented description of sim
+def _desc_xml(sim: mc.Simulation) -> str:
+    parts = ['<simulation>', _PARAMS_TMPL.format(
+        title=escape(sim.title), encounters=sim.encounters, generations=sim.generations,
+        repetitions=sim.repetitions, repopulate=_BOOL01[bool(sim.repopulate)]
+    )]
+
+    parts.append('<prey_pool>')
     for prey_name, prey_obj in sim.prey_pool:
-        prey_elem = et.SubElement(prey_pool, 'prey_spec')
-        et.SubElement(prey_elem, 'spec_name').text = prey_name
-        et.SubElement(prey_elem, 'popu').text = str(prey_obj.popu)
-        et.SubElement(prey_elem, 'phen').text = prey_obj.phen
-        et.SubElement(prey_elem, 'size').text = str(prey_obj.size)
-        et.SubElement(prey_elem, 'camo').text = str(prey_obj.camo)
-        et.SubElement(prey_elem, 'pal').text = str(prey_obj.pal)
-
-    pred_pool = et.SubElement(root, 'pred_pool')
+        parts.append(_PREY_SPEC_TMPL.format(
+            name=escape(prey_name), popu=prey_obj.popu, phen=escape(prey_obj.phen),
+            size=prey_obj.size, camo=prey_obj.camo, pal=prey_obj.pal
+        ))
+    parts.append('</prey_pool>')
+
+    parts.append('<pred_pool>')
     for pred_name, pred_obj in sim.pred_pool:
-        pred_elem = et.SubElement(pred_pool, 'pred_spec')
-        et.SubElement(pred_elem, 'spec_name').text = pred_name
-        et.SubElement(pred_elem, 'popu').text = str(pred_obj.popu)
-        et.SubElement(pred_elem, 'app').text = str(pred_obj.app)
-        et.SubElement(pred_elem, 'mem').text = str(pred_obj.mem)
-        et.SubElement(pred_elem, 'insatiable').text = str(int(pred_obj.insatiable))
+        parts.append(_PRED_SPEC_TMPL.format(
+            name=escape(pred_name), popu=pred_obj.popu, app=pred_obj.app, mem=pred_obj.mem,
+            insatiable=_BOOL01[pred_obj.insatiable]
+        ))
+    parts.append('</pred_pool>')
 
-    return et.ElementTree(root)
+    parts.append('</simulation>')
+    return ''.join(parts)
+
+
+def _build_desc(sim: mc.Simulation) -> et.ElementTree:
+    return et.ElementTree(et.fromstring(_desc_xml(sim)))
 
 
 # write description of sim to the specified .simu.xml file
-def write_desc(sim: mc.Simulation, destination_folder: str, alt_title=None) \
+# descriptions are small and often edited by hand, so they are indented unless pretty_print=False
+def write_desc(sim: mc.Simulation, destination_folder: str, alt_title=None, pretty_print: bool = True) \
         -> NoReturn:
-    if not destination_folder or destination_folder[-1] != '/':
-        destination_folder += '/'
-    filename = destination_folder + (sim.title if alt_title is None else alt_title)
-    data_tree = _build_desc(sim)
-    data_tree.write(filename + '.simu.xml', xml_declaration=True, pretty_print=True)
+    filename = os.path.join(destination_folder, sim.title if alt_title is None else alt_title)
+    with open(filename + '.simu.xml', 'wb', buffering=_XML_BUFFER_SIZE) as file_out:
+        if pretty_print:
+            data_tree = _build_desc(sim)
+            data_tree.write(file_out, xml_declaration=True, pretty_print=True)
+        else:  # the description string is already what lxml would write, so it goes straight to disk
+            file_out.write(_XML_DECLARATION)
+            file_out.write(_desc_xml(sim).encode('ascii', 'xmlcharrefreplace'))
+
+
+_INDENT = '  '  # matches lxml's pretty_print, so streamed files read the same as ones written from a tree
+
+
+# within the open xmlfile xf, write elem as a child at the given depth, indented as pretty_print would if pretty
+def _write_indented(xf: et.xmlfile, elem: et.Element, depth: int, pretty: bool) -> NoReturn:
+    if pretty:
+        et.indent(elem, space=_INDENT, level=depth)
+        xf.write('\n' + _INDENT * depth)
+    xf.write(elem)
+
+
+# within the open xmlfile xf, open an element at the given depth whose children are written in the with-block
+@contextmanager
+def _stream_elem(xf: et.xmlfile, tag: str, depth: int, pretty: bool):
+    if pretty:
+        xf.write('\n' + _INDENT * depth)
+    with xf.element(tag):
+        yield
+        if pretty:
+            xf.write('\n' + _INDENT * depth)
+
+
+_GEN_TMPL = '<generation><generation_number>{}</generation_number><{tag}>{}</{tag}></generation>'
+
+
+# within the open xmlfile xf, write the results of one species: each trial's (generation, value) pairs under value_tag
+# each trial is formatted as one string and parsed in a single call, rather than built a node at a time
+def _write_spec_results(xf: et.xmlfile, trials: List[Tuple[int, List[int]]], values: List[List[int]],
+                        value_tag: str, depth: int, pretty: bool) -> NoReturn:
+    gen_tmpl = _GEN_TMPL.replace('{tag}', value_tag)
+    with _stream_elem(xf, 'results', depth, pretty):
+        for (trial, gens), trial_values in zip(trials, values):
+            trial_xml = ''.join(map(gen_tmpl.format, gens, trial_values))
+            trial_node = et.fromstring(f'<trial><trial_number>{trial}</trial_number>{trial_xml}</trial>')
+            _write_indented(xf, trial_node, depth + 1, pretty)
 
 
 # write description and results of sim to the specified .simu.xml file, yielding each generation
+# results are kept as plain ints while the sim runs, since each species' results sit inside its own description;
+# the file is then serialized one element at a time rather than from a whole document tree
+# results files are large and read by programs, so they are only indented if pretty_print=True
 # not recommended to use; prefer the wrapper sim.iter_run(..., output=controller.XML)
-def write_results(sim: mc.Simulation, filename: str, verbose: bool = False) \
+def write_results(sim: mc.Simulation, filename: str, verbose: bool = False, pretty_print: bool = False) \
         -> Iterable[Tuple[mim.PreyPool, mim.PredatorPool, int]]:
-    sim_tree = _build_desc(sim)
-    root = sim_tree.getroot()
-
     prey_names = sim.prey_pool.names
-    prey_root = root.find('prey_pool')
-    prey_result_roots = dict()
-    for prey_species_root in prey_root.findall('prey_spec'):
-        spec_name = prey_species_root.findtext('spec_name')
-        prey_result_roots[spec_name] = et.SubElement(prey_species_root, 'results')
-
     pred_names = sim.pred_pool.names
-    pred_root = root.find('pred_pool')
-    pred_result_roots = dict()
-    for pred_species_root in pred_root.findall('pred_spec'):
-        spec_name = pred_species_root.findtext('spec_name')
-        pred_result_roots[spec_name] = et.SubElement(pred_species_root, 'results')
-
-    prey_trial_nodes = dict()  # These two statements do nothing but avoid a warning
-    pred_trial_nodes = dict()
+    trials = []  # (trial number, generation numbers) for each trial run
+    prey_results = {name: [] for name in prey_names}  # population per generation, for each trial
+    pred_results = {name: [] for name in pred_names}  # hungry population per generation, for each trial
 
     last_trial = -1
+    trial_gens = []
+    prey_appends = pred_appends = ()  # per species, in name order, the append of its list for the current trial
     for trial, gen, prey_out, pred_out in sim.run_raw(verbose=verbose):
         if trial > last_trial:
             last_trial = trial
-            prey_trial_nodes = {name: et.SubElement(prey_result_roots[name], 'trial') for name in prey_names}
-            for node in prey_trial_nodes.values():
-                et.SubElement(node, 'trial_number').text = str(trial)
-            pred_trial_nodes = {name: et.SubElement(pred_result_roots[name], 'trial') for name in pred_names}
-            for node in pred_trial_nodes.values():
-                et.SubElement(node, 'trial_number').text = str(trial)
-
-        for prey_species in prey_names:
-            this_gen_node = et.SubElement(prey_trial_nodes[prey_species], 'generation')
-            et.SubElement(this_gen_node, 'generation_number').text = str(gen)
-            et.SubElement(this_gen_node, 'population').text = str(prey_out.popu(prey_species))
-
-        for pred_species in pred_names:
-            this_gen_node = et.SubElement(pred_trial_nodes[pred_species], 'generation')
-            et.SubElement(this_gen_node, 'generation_number').text = str(gen)
-            et.SubElement(this_gen_node, 'population_hungry').text = str(pred_out.popu(pred_species, hungry_only=True))
+            trial_gens = []
+            trials.append((trial, trial_gens))
+            for results in prey_results.values():
+                results.append([])
+            for results in pred_results.values():
+                results.append([])
+            prey_appends = tuple(prey_results[name][-1].append for name in prey_names)
+            pred_appends = tuple(pred_results[name][-1].append for name in pred_names)
+
+        trial_gens.append(gen)
+        for append, prey_obj in zip(prey_appends, prey_out.objects):  # objects are in name order, as are the appends
+            append(prey_obj.popu)
+        for append, pred_obj in zip(pred_appends, pred_out.objects):
+            append(pred_obj.popu_hungry())
 
         yield prey_out, pred_out, gen
 
-    sim_tree.write(filename + '.simu.xml', xml_declaration=True, pretty_print=True)
+    desc_root = _build_desc(sim).getroot()
+    with open(filename + '.simu.xml', 'wb', buffering=_XML_BUFFER_SIZE) as file_out:
+        with et.xmlfile(file_out, encoding='ASCII') as xf:
+            xf.write_declaration()
+            with xf.element('simulation'):
+                _write_indented(xf, desc_root.find('params'), 1, pretty_print)
+                with _stream_elem(xf, 'prey_pool', 1, pretty_print):
+                    for prey_elem in desc_root.find('prey_pool'):
+                        with _stream_elem(xf, 'prey_spec', 2, pretty_print):
+                            for child in prey_elem:
+                                _write_indented(xf, child, 3, pretty_print)
+                            prey_name = prey_elem.findtext('spec_name')
+                            _write_spec_results(xf, trials, prey_results.pop(prey_name), 'population', 3,
+                                                pretty_print)
+                with _stream_elem(xf, 'pred_pool', 1, pretty_print):
+                    for pred_elem in desc_root.find('pred_pool'):
+                        with _stream_elem(xf, 'pred_spec', 2, pretty_print):
+                            for child in pred_elem:
+                                _write_indented(xf, child, 3, pretty_print)
+                            pred_name = pred_elem.findtext('spec_name')
+                            _write_spec_results(xf, trials, pred_results.pop(pred_name), 'population_hungry', 3,
+                                                pretty_print)
+                if pretty_print:
+                    xf.write('\n')
+        if pretty_print:
+            file_out.write(b'\n')